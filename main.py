@@ -1,9 +1,15 @@
 import os
+import sys
 import base64
 import asyncio
+import hashlib
 import aiohttp
-from typing import List, Optional, Union, Literal
+import orjson
+from collections import OrderedDict
+from io import BytesIO
+from typing import AsyncIterator, List, Optional, Tuple, Union, Literal
 
+from PIL import Image as PILImage
 from pydantic import BaseModel, Field
 
 
@@ -20,9 +26,14 @@ class ModelInfo(BaseModel):
 class OllamaConfig(BaseModel):
     """Configuration for Ollama API"""
     model: str
-    base_url: str = "http://localhost:11434/v1"
+    base_url: str = "http://localhost:11434"
+    unix_socket: Optional[str] = None  # Connect over this Unix socket instead of TCP when set
     api_key: str = "ollama"  # Not used by Ollama but included for compatibility
     model_info: ModelInfo
+    max_image_size: int = 896  # Gemma3's vision input resolution; larger images are downscaled
+    keep_alive: Optional[str] = None  # How long Ollama keeps the model loaded; None uses the server setting
+    cache_enabled: bool = True  # Reuse responses for identical model/prompt/images
+    cache_size: int = 128
 
 
 class TextContent(BaseModel):
@@ -57,63 +68,187 @@ class VisionAgent:
         """Initialize the agent with configuration"""
         self.config = config
         self.name = "vision_agent"
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._cache: "OrderedDict[Tuple, AssistantResponse]" = OrderedDict()
     
-    async def process_message(self, message: MultiModalMessage) -> AssistantResponse:
-        """Process a multimodal message and return a response"""
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            if self.config.unix_socket:
+                connector = aiohttp.UnixConnector(
+                    path=self.config.unix_socket, limit=100, keepalive_timeout=75
+                )
+            else:
+                connector = aiohttp.TCPConnector(limit=100, keepalive_timeout=75)
+            timeout = aiohttp.ClientTimeout(total=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+    
+    async def aclose(self) -> None:
+        """Close the shared HTTP session"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+    
+    async def __aenter__(self) -> "VisionAgent":
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.aclose()
+    
+    async def _encode_image(self, item: ImageContent) -> str:
+        """Downscale and base64-encode an image in a worker thread"""
+        # Pillow releases the GIL while decoding, resizing and saving, so
+        # oversized images don't stall the event loop; base64 itself doesn't
+        encoded = await asyncio.to_thread(_downscale_and_encode, item.data, self.config.max_image_size)
+        return encoded.decode('ascii')
+    
+    async def stream_message(self, message: MultiModalMessage) -> AsyncIterator[str]:
+        """Process a multimodal message, yielding response text as it is generated"""
         # Extract text and images from the message
-        prompt = " ".join([item.data for item in message.content if item.type == "text"])
-        image_items = [item for item in message.content if item.type == "image"]
+        texts, image_items = [], []
+        for item in message.content:
+            if item.type == "text":
+                texts.append(item.data)
+            else:
+                image_items.append(item)
+        prompt = " ".join(texts)
         
         print(f"Processing request with {len(image_items)} image(s)")
         print(f"Prompt: {prompt}")
         
-        try:
-            # Prepare for API call
-            print("\nSending request to Ollama...")
-            headers = {"Content-Type": "application/json"}
-            
-            # Prepare base64 encoded images
-            image_contents = []
-            for item in image_items:
-                encoded = base64.b64encode(item.data).decode('utf-8')
-                image_contents.append({
-                    "type": "image_url", 
-                    "image_url": {"url": f"data:image/jpeg;base64,{encoded}"}
-                })
-            
-            # Combine text and images into API payload
-            payload = {
-                "model": self.config.model,
-                "messages": [
-                    {
-                        "role": "user", 
-                        "content": [{"type": "text", "text": prompt}] + image_contents
-                    }
-                ],
-            }
+        # Key on the raw image bytes so identical images hit regardless of source
+        cache_key = None
+        if self.config.cache_enabled:
+            cache_key = (
+                self.config.model,
+                prompt,
+                tuple(hashlib.sha256(item.data).digest() for item in image_items),
+            )
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._cache.move_to_end(cache_key)
+                print("\nUsing cached response")
+                yield cached.content
+                return
+        
+        # Prepare for API call
+        print("\nSending request to Ollama...")
+        headers = {"Content-Type": "application/json"}
+        
+        # Prepare base64 encoded images (Ollama's native API takes them
+        # without a data URL wrapper)
+        images = list(await asyncio.gather(*(self._encode_image(item) for item in image_items)))
+        
+        # Combine text and images into API payload
+        payload = {
+            "model": self.config.model,
+            "messages": [
+                {
+                    "role": "user", 
+                    "content": prompt,
+                    "images": images
+                }
+            ],
+            "stream": True,
+        }
+        # Only override how long the model stays loaded when asked to, so the
+        # server's OLLAMA_KEEP_ALIVE applies otherwise
+        if self.config.keep_alive is not None:
+            payload["keep_alive"] = self.config.keep_alive
+        
+        # Make the API call over the shared keep-alive session
+        session = await self._get_session()
+        parts = []
+        done = False
+        async with session.post(
+            f"{self.config.base_url}/api/chat", 
+            headers=headers, 
+            data=orjson.dumps(payload)
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise Exception(f"API error (status {response.status}): {error_text}")
             
-            # Make the API call
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.config.base_url}/chat/completions", 
-                    headers=headers, 
-                    json=payload
-                ) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        raise Exception(f"API error (status {response.status}): {error_text}")
-                    
-                    result = await response.json()
-                    return AssistantResponse(content=result["choices"][0]["message"]["content"])
-                    
+            # Ollama streams one JSON object per line
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                chunk = orjson.loads(line)
+                if "error" in chunk:
+                    raise Exception(f"API error: {chunk['error']}")
+                text = chunk.get("message", {}).get("content", "")
+                if text:
+                    parts.append(text)
+                    yield text
+                done = chunk.get("done", False)
+        
+        # Never cache a response whose stream was cut short
+        if not done:
+            raise Exception("API error: response stream ended before completion")
+        
+        if cache_key is not None:
+            self._cache[cache_key] = AssistantResponse(content="".join(parts))
+            if len(self._cache) > self.config.cache_size:
+                self._cache.popitem(last=False)
+    
+    async def process_message(self, message: MultiModalMessage) -> AssistantResponse:
+        """Process a multimodal message and return a response"""
+        try:
+            parts = [text async for text in self.stream_message(message)]
+            return AssistantResponse(content="".join(parts))
         except Exception as e:
             error_message = f"Error processing image with Ollama: {str(e)}"
             print(error_message)
             return AssistantResponse(content=f"Error: {str(e)}")
 
 
+def _downscale_and_encode(data: bytes, max_size: int) -> bytes:
+    """Fit an image within max_size x max_size and return it base64-encoded"""
+    # Opening only parses the header, so images that already fit are sent
+    # as their original bytes without a decode/re-encode round-trip
+    image = PILImage.open(BytesIO(data))
+    if image.width <= max_size and image.height <= max_size:
+        return base64.b64encode(data)
+    if image.mode in ("LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+    image.thumbnail((max_size, max_size), PILImage.Resampling.LANCZOS)
+    # JPEG has no alpha, so flatten transparent areas onto white rather than
+    # letting convert() turn them black
+    if image.mode == "RGBA":
+        background = PILImage.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return base64.b64encode(buffer.getvalue())
+
+
+def _read_file(path: str) -> bytes:
+    """Read a file's contents in full"""
+    with open(path, "rb") as f:
+        return f.read()
+
+
 async def main():
     """Main entry point for the application"""
+    # With OLLAMA_AGENT_PROFILE set, asyncio reports to stderr every callback
+    # that blocks the event loop for longer than the threshold (in ms)
+    profile_ms = os.environ.get("OLLAMA_AGENT_PROFILE")
+    if profile_ms:
+        try:
+            threshold = float(profile_ms)
+            if not 0 <= threshold < float("inf"):
+                raise ValueError
+        except ValueError:
+            print(f"Warning: ignoring OLLAMA_AGENT_PROFILE={profile_ms!r}, expected a non-negative number of milliseconds")
+        else:
+            loop = asyncio.get_running_loop()
+            loop.set_debug(True)
+            loop.slow_callback_duration = threshold / 1000
+    
     print("=== Pydantic Vision Agent for Ollama ===")
     print("Using structured data validation with Pydantic")
     
@@ -142,9 +277,8 @@ async def main():
         print(os.listdir("."))
         return
     
-    # Load the image data
-    with open(image_path, "rb") as f:
-        image_data = f.read()
+    # Load the image data off the event loop
+    image_data = await asyncio.to_thread(_read_file, image_path)
     
     # Create a structured multimodal message
     message = MultiModalMessage(
@@ -155,11 +289,33 @@ async def main():
         source="user"
     )
     
-    # Process the message and get response
-    response = await agent.process_message(message)
-    print("\nResponse from Ollama:")
-    print(response.content)
+    # Process the message and print the response as it streams in
+    try:
+        started = False
+        async for text in agent.stream_message(message):
+            if not started:
+                print("\nResponse from Ollama:")
+                started = True
+            print(text, end="", flush=True)
+        print()
+    except Exception as e:
+        print(f"\nError processing image with Ollama: {str(e)}")
+    finally:
+        await agent.aclose()
+
+
+def run(coro):
+    """Run a coroutine to completion, on uvloop when it is installed"""
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.run(coro)
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(coro)
+    uvloop.install()
+    return asyncio.run(coro)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    run(main())